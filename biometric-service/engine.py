@@ -1,7 +1,125 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
 import cv2
 import numpy as np
 import insightface
+import onnxruntime
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
+from insightface.utils import face_align
+
+def available_cpus() -> int:
+    """CPUs this process may run on (respects container cpusets/affinity, unlike os.cpu_count())."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS / Windows
+        return os.cpu_count() or 1
+
+# Face templates of recently seen images are held in process memory only, never
+# persisted. Long enough to absorb client retries of the same upload, not to keep templates around.
+# EMBEDDING_CACHE_MAX_AGE_SEC is the retention promised in PRIVACY_POLICY.md §2.1: a sweeper purges
+# expired entries every EMBEDDING_CACHE_SWEEP_SEC, so the configurable TTL is clamped to leave room
+# for one sweep. BIOMETRIC_EMBEDDING_CACHE_TTL=0 disables the cache.
+EMBEDDING_CACHE_SIZE = 256
+EMBEDDING_CACHE_MAX_AGE_SEC = 120
+EMBEDDING_CACHE_SWEEP_SEC = 5
+EMBEDDING_CACHE_TTL_SEC = min(
+    float(os.getenv("BIOMETRIC_EMBEDDING_CACHE_TTL", "60")),
+    EMBEDDING_CACHE_MAX_AGE_SEC - EMBEDDING_CACHE_SWEEP_SEC,
+)
+
+# INT8 copies of the buffalo_l models produced by quantize_models.py.
+# Opt-in with BIOMETRIC_INT8=1 once their accuracy has been checked; the FP32
+# session is used whenever the INT8 file is missing or fails to load.
+INT8_MODEL_DIR = os.getenv(
+    "BIOMETRIC_INT8_MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+)
+USE_INT8_MODELS = os.getenv("BIOMETRIC_INT8", "0") == "1"
+
+def int8_model_path(model_file: str) -> str:
+    """Location of the quantized copy of an InsightFace model file."""
+    name, ext = os.path.splitext(os.path.basename(model_file))
+    return os.path.join(INT8_MODEL_DIR, f"{name}.int8{ext}")
+
+# Cascade detection: try the cheap resolution first, retry at full size only if no face is found
+DET_SIZE_SMALL = (320, 320)
+DET_SIZE_FULL = (640, 640)
+
+# Micro-batching window for the recognition model
+MAX_BATCH = 8
+MAX_WAIT_MS = 10
+# Upper bound on waiting for the batcher, so a stuck model can't hang executor threads
+EMBED_TIMEOUT_SEC = 30
+
+def detect_faces(det_model, img: np.ndarray) -> list:
+    """
+    Runs SCRFD at DET_SIZE_SMALL, retrying at DET_SIZE_FULL if no face is found.
+    Verification selfies are face-dominant, so 320x320 (~4x fewer FLOPs) usually
+    suffices; the recognizer runs on the aligned crop either way.
+    """
+    bboxes, kpss = det_model.detect(img, input_size=DET_SIZE_SMALL, max_num=0, metric='default')
+    if bboxes.shape[0] == 0:
+        bboxes, kpss = det_model.detect(img, input_size=DET_SIZE_FULL, max_num=0, metric='default')
+    return [Face(bbox=bboxes[j, 0:4], kps=kpss[j], det_score=bboxes[j, 4]) for j in range(bboxes.shape[0])]
+
+def largest_face(faces: list) -> Face:
+    """Takes the largest face if multiple are found (prevent background face mismatch)."""
+    # bbox is [x1, y1, x2, y2], so area is (x2 - x1) * (y2 - y1)
+    return max(faces, key=lambda f: (f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1]))
+
+class BatchedRecognizer:
+    """
+    Coalesces ArcFace calls from concurrent requests into one batched ONNX run.
+    Callers submit() crops and wait on the futures; a single worker thread drains up to MAX_BATCH
+    aligned crops (or whatever arrived within MAX_WAIT_MS) and runs them together.
+    """
+    def __init__(self, rec_model, max_batch: int = MAX_BATCH, max_wait_ms: int = MAX_WAIT_MS):
+        self.rec_model = rec_model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="arcface-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, aligned_face: np.ndarray) -> Future:
+        """Queues one 112x112 aligned face crop; the future resolves to its raw embedding."""
+        if not self._worker.is_alive():
+            raise RuntimeError("ArcFace batcher thread is not running")
+        future = Future()
+        self._queue.put((aligned_face, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Everything after the first get is guarded: the worker must never
+            # die and leave callers waiting on futures nobody will resolve
+            try:
+                deadline = time.monotonic() + self.max_wait
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+
+                feats = self.rec_model.get_feat([crop for crop, _ in batch])
+                for (_, future), feat in zip(batch, feats):
+                    future.set_result(feat)
+                error = RuntimeError("Recognition model returned fewer embeddings than crops")
+            except Exception as e:
+                error = e
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
 
 class BiometricEngine:
     def __init__(self):
@@ -9,12 +127,65 @@ class BiometricEngine:
         # Initialize FaceAnalysis with default models
         # This will download models to ~/.insightface/models/ on first run if not present
         # 'buffalo_l' is accurate but lightweight enough for CPU usage
-        self.app = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
+        # Prefer CUDA when the installed onnxruntime build exposes it, else CPU
+        available = onnxruntime.get_available_providers()
+        providers = [p for p in ['CUDAExecutionProvider', 'CPUExecutionProvider'] if p in available]
+        print(f"[BiometricEngine] Execution providers: {providers}")
+        # Only detection + recognition are used; skip the landmark/genderage models
+        self.app = FaceAnalysis(
+            name='buffalo_l',
+            allowed_modules=['detection', 'recognition'],
+            providers=providers,
+        )
+        
+        # Recreate the ORT sessions with explicit thread counts (FaceAnalysis does
+        # not forward SessionOptions). Detection runs on the executor workers, one
+        # verification per core, so it gets a single intra-op thread. Recognition
+        # runs only on the BatchedRecognizer thread, so it keeps a thread per core.
+        # Spinning is disabled so idle pool threads sleep instead of busy-waiting:
+        # otherwise N executor workers plus N spinning recognizer threads would
+        # contend for N cores under load.
+        for taskname, model in self.app.models.items():
+            sess_options = onnxruntime.SessionOptions()
+            sess_options.intra_op_num_threads = available_cpus() if taskname == 'recognition' else 1
+            sess_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+            quantized = int8_model_path(model.model_file)
+            if USE_INT8_MODELS and os.path.exists(quantized):
+                try:
+                    model.session = onnxruntime.InferenceSession(
+                        quantized, sess_options=sess_options, providers=providers
+                    )
+                    print(f"[BiometricEngine] Using INT8 model {quantized}")
+                    continue
+                except Exception as e:
+                    print(f"[BiometricEngine] INT8 model {quantized} failed to load, using FP32: {e}")
+            model.session = onnxruntime.InferenceSession(
+                model.model_file, sess_options=sess_options, providers=providers
+            )
         
         # Prepare the model with strict detection size (640x640 is standard)
-        self.app.prepare(ctx_id=0, det_size=(640, 640))
+        self.app.prepare(ctx_id=0, det_size=DET_SIZE_FULL)
+
+        # Keep OpenCV single-threaded so it does not oversubscribe cores against ORT
+        cv2.setNumThreads(1)
+
+        # Warm-up pass: allocates ORT arenas / compiles CUDA kernels before the first real request
+        # (a blank frame has no faces, so the recognition model is warmed separately)
+        self.app.get(np.zeros((640, 640, 3), dtype=np.uint8))
+        self._det_model = self.app.det_model
+        self._det_model.detect(np.zeros((640, 640, 3), dtype=np.uint8), input_size=DET_SIZE_SMALL)
+        self._rec_model = self.app.models['recognition']
+        self._rec_model.get_feat(np.zeros((112, 112, 3), dtype=np.uint8))
+        self._recognizer = BatchedRecognizer(self._rec_model)
         print("[BiometricEngine] Model loaded successfully.")
 
+        # LRU of image digest -> (expiry, (normed embedding or None, face count)).
+        # verify() runs on executor threads, so access is guarded by a lock.
+        self._emb_cache = OrderedDict()
+        self._emb_cache_lock = threading.Lock()
+        if EMBEDDING_CACHE_TTL_SEC > 0:
+            threading.Thread(target=self._sweep_cache, name="embedding-cache-sweeper", daemon=True).start()
+
     def _decode_image(self, image_bytes: bytes):
         try:
             nparr = np.frombuffer(image_bytes, np.uint8)
@@ -24,36 +195,87 @@ class BiometricEngine:
             print(f"[BiometricEngine] Decode error: {e}")
             return None
 
+    def _embed(self, *imgs: np.ndarray) -> list:
+        """
+        Returns [(normed embedding of the largest face, number of faces detected)]
+        for each image. The embedding is None when no face is found. Results are
+        briefly cached by a digest of the pixel data so retried uploads skip inference.
+        Every crop is submitted to the recognizer before waiting on any, so the
+        faces of one verification share a batch.
+        """
+        results = [None] * len(imgs)
+        pending = []
+        for i, img in enumerate(imgs):
+            img = np.ascontiguousarray(img)
+            key = (img.shape, hashlib.blake2b(img.data, digest_size=16).digest())
+            with self._emb_cache_lock:
+                cached = self._emb_cache.get(key)
+                if cached is not None:
+                    expiry, result = cached
+                    if expiry > time.monotonic():
+                        self._emb_cache.move_to_end(key)
+                        results[i] = result
+                        continue
+                    del self._emb_cache[key]
+
+            # Detection runs per image (insightface's SCRFD wrapper only decodes
+            # batch index 0); recognition is micro-batched across concurrent requests.
+            faces = detect_faces(self._det_model, img)
+            if faces:
+                face = largest_face(faces)
+                aligned = face_align.norm_crop(img, landmark=face.kps, image_size=self._rec_model.input_size[0])
+                pending.append((i, key, self._recognizer.submit(aligned), len(faces)))
+            else:
+                results[i] = (None, 0)
+                self._cache_put(key, results[i])
+
+        for i, key, future, face_count in pending:
+            embedding = future.result(timeout=EMBED_TIMEOUT_SEC)
+            # Raw ArcFace output is not unit-norm; normalize it here
+            results[i] = (embedding / np.linalg.norm(embedding), face_count)
+            self._cache_put(key, results[i])
+        return results
+
+    def _cache_put(self, key, result):
+        if EMBEDDING_CACHE_TTL_SEC <= 0:
+            return
+        with self._emb_cache_lock:
+            self._emb_cache[key] = (time.monotonic() + EMBEDDING_CACHE_TTL_SEC, result)
+            if len(self._emb_cache) > EMBEDDING_CACHE_SIZE:
+                self._emb_cache.popitem(last=False)
+
+    def _sweep_cache(self):
+        """Purges expired templates even when no requests arrive, enforcing EMBEDDING_CACHE_MAX_AGE_SEC."""
+        while True:
+            time.sleep(EMBEDDING_CACHE_SWEEP_SEC)
+            now = time.monotonic()
+            with self._emb_cache_lock:
+                for stale in [k for k, (expiry, _) in self._emb_cache.items() if expiry <= now]:
+                    del self._emb_cache[stale]
+
     def verify(self, img1_bytes: bytes, img2_bytes: bytes) -> dict:
         img1 = self._decode_image(img1_bytes)
         img2 = self._decode_image(img2_bytes)
+        return self.verify_ndarray(img1, img2)
 
+    def verify_ndarray(self, img1: np.ndarray, img2: np.ndarray) -> dict:
+        """Verifies two already-decoded BGR images (as returned by cv2.imdecode)."""
         if img1 is None or img2 is None:
             return {"error": "Invalid image data - could not decode", "match": False, "score": 0.0}
 
-        # Detect faces
-        faces1 = self.app.get(img1)
-        faces2 = self.app.get(img2)
+        (embedding1, count1), (embedding2, count2) = self._embed(img1, img2)
 
-        if not faces1 or not faces2:
+        if embedding1 is None or embedding2 is None:
             return {
                 "error": "Face not detected in one or both images", 
                 "match": False, 
                 "score": 0.0,
-                "faces_detected": [len(faces1), len(faces2)]
+                "faces_detected": [count1, count2]
             }
 
-        # Take largest face if multiple are found (prevent background face mismatch)
-        face1 = sorted(faces1, key=lambda x: x.bbox[2]*x.bbox[3], reverse=True)[0]
-        face2 = sorted(faces2, key=lambda x: x.bbox[2]*x.bbox[3], reverse=True)[0]
-
         # Calculate Cosine Similarity
-        # InsightFace embeddings are normalized, so simple dot product is sufficient
-        # but we do full normalization formula to be safe.
-        embedding1 = face1.embedding
-        embedding2 = face2.embedding
-        
-        similarity = np.dot(embedding1, embedding2) / (np.linalg.norm(embedding1) * np.linalg.norm(embedding2))
+        # Embeddings are L2-normalized, so a plain dot product is the cosine similarity.
+        similarity = float(np.dot(embedding1, embedding2))
         score = float(max(0, similarity)) # Clamp negative values (unlikely but possible)
         
         # Threshold: 0.4 is typical for arcface verification in wild
@@ -65,5 +287,5 @@ class BiometricEngine:
             "match": score > threshold,
             "score": score,
             "threshold": threshold,
-            "faces_detected": [len(faces1), len(faces2)]
+            "faces_detected": [count1, count2]
         }
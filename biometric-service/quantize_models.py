@@ -0,0 +1,153 @@
+"""
+Offline INT8 quantization for the buffalo_l models used by BiometricEngine.
+
+Both models are pure CNNs (SCRFD detector, IResNet-50 ArcFace), so they are
+quantized statically in QDQ format with activation ranges calibrated on real
+face images. ONNX Runtime fuses QDQ into QLinearConv kernels; dynamic
+quantization would instead emit ConvInteger, which is slow or unsupported on
+the CPU/CUDA providers.
+
+The detector is calibrated at both cascade sizes the engine runs. After
+quantizing, every calibration image goes through the full production
+pipeline (detect -> align -> embed) once with the FP32 models and once with
+the INT8 ones, and the script reports how often the INT8 detector misses a
+face plus the cosine between the two embeddings. Check that agreement before
+enabling the models with BIOMETRIC_INT8=1: verification decisions use a
+fixed 0.4 threshold.
+
+Usage:
+    python quantize_models.py --calib-dir <folder of face photos>
+        [--src ~/.insightface/models/buffalo_l]
+"""
+
+import argparse
+import copy
+import glob
+import os
+
+import cv2
+import numpy as np
+import onnxruntime
+from insightface.model_zoo import get_model
+from insightface.utils import face_align
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+from engine import (
+    DET_SIZE_FULL, DET_SIZE_SMALL, INT8_MODEL_DIR, detect_faces, int8_model_path, largest_face,
+)
+
+# buffalo_l files BiometricEngine loads (FaceAnalysis allowed_modules=['detection', 'recognition'])
+DET_MODEL_FILE = "det_10g.onnx"
+REC_MODEL_FILE = "w600k_r50.onnx"
+
+class BlobReader(CalibrationDataReader):
+    """Feeds precomputed input blobs to the calibrator one at a time."""
+    def __init__(self, input_name: str, blobs: list):
+        self._feeds = iter([{input_name: blob} for blob in blobs])
+
+    def get_next(self):
+        return next(self._feeds, None)
+
+def detection_blob(det_model, img: np.ndarray, input_size: tuple) -> np.ndarray:
+    """Letterboxes img to input_size the same way SCRFD.detect does."""
+    width, height = input_size
+    scale = min(width / img.shape[1], height / img.shape[0])
+    resized = cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)))
+    canvas = np.zeros((height, width, 3), dtype=np.uint8)
+    canvas[:resized.shape[0], :resized.shape[1], :] = resized
+    return cv2.dnn.blobFromImage(
+        canvas, 1.0 / det_model.input_std, input_size, (det_model.input_mean,) * 3, swapRB=True
+    )
+
+def recognition_blob(rec_model, aligned: np.ndarray) -> np.ndarray:
+    return cv2.dnn.blobFromImages(
+        [aligned], 1.0 / rec_model.input_std, rec_model.input_size, (rec_model.input_mean,) * 3, swapRB=True
+    )
+
+def embed(det_model, rec_model, img: np.ndarray):
+    """BiometricEngine's pipeline for one image: normed embedding of the largest face, or None."""
+    faces = detect_faces(det_model, img)
+    if not faces:
+        return None
+    aligned = face_align.norm_crop(img, landmark=largest_face(faces).kps, image_size=rec_model.input_size[0])
+    embedding = rec_model.get_feat(aligned)[0]
+    return embedding / np.linalg.norm(embedding)
+
+def with_int8_session(model):
+    """Copy of an InsightFace model wrapper running its INT8 file (as the engine swaps sessions)."""
+    quantized = copy.copy(model)
+    quantized.session = onnxruntime.InferenceSession(
+        int8_model_path(model.model_file), providers=['CPUExecutionProvider']
+    )
+    return quantized
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--src",
+        default=os.path.expanduser("~/.insightface/models/buffalo_l"),
+        help="Directory containing the FP32 buffalo_l models",
+    )
+    parser.add_argument("--calib-dir", required=True, help="Folder of face photos used for calibration")
+    args = parser.parse_args()
+
+    # Load the exact files under --src (never let FaceAnalysis resolve or download a pack)
+    model_paths = [os.path.join(args.src, name) for name in (DET_MODEL_FILE, REC_MODEL_FILE)]
+    missing = [path for path in model_paths if not os.path.isfile(path)]
+    if missing:
+        raise SystemExit(f"{args.src} is not a buffalo_l model directory, missing: {', '.join(missing)}")
+    det_model, rec_model = (get_model(path, providers=['CPUExecutionProvider']) for path in model_paths)
+    det_model.prepare(ctx_id=-1, input_size=DET_SIZE_FULL)
+    rec_model.prepare(ctx_id=-1)
+
+    images, det_blobs, rec_blobs = [], [], []
+    for path in sorted(glob.glob(os.path.join(args.calib_dir, "*"))):
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        images.append(img)
+        # The engine tries DET_SIZE_SMALL first, so calibrate activation ranges at both sizes
+        for input_size in (DET_SIZE_SMALL, DET_SIZE_FULL):
+            det_blobs.append(detection_blob(det_model, img, input_size))
+        for face in detect_faces(det_model, img):
+            aligned = face_align.norm_crop(img, landmark=face.kps, image_size=rec_model.input_size[0])
+            rec_blobs.append(recognition_blob(rec_model, aligned))
+    if not rec_blobs:
+        raise SystemExit(f"No faces found in {args.calib_dir}; calibration needs real face photos")
+    print(f"Calibrating on {len(images)} images / {len(rec_blobs)} faces")
+
+    os.makedirs(INT8_MODEL_DIR, exist_ok=True)
+    for model, blobs in ((det_model, det_blobs), (rec_model, rec_blobs)):
+        dst = int8_model_path(model.model_file)
+        print(f"Quantizing {model.model_file} -> {dst}")
+        quantize_static(
+            model.model_file,
+            dst,
+            BlobReader(model.input_name, blobs),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+        )
+
+    # Accuracy check on the full pipeline: the INT8 detector's landmarks drive
+    # alignment, so compare end-to-end embeddings rather than shared crops
+    int8_det, int8_rec = with_int8_session(det_model), with_int8_session(rec_model)
+    similarities, missed, extra = [], 0, 0
+    for img in images:
+        fp32 = embed(det_model, rec_model, img)
+        int8 = embed(int8_det, int8_rec, img)
+        if fp32 is None or int8 is None:
+            missed += fp32 is not None
+            extra += int8 is not None
+            continue
+        similarities.append(float(np.dot(fp32, int8)))
+    print(f"INT8 detector: {missed} faces missed, {extra} faces not found by FP32 (of {len(images)} images)")
+    if similarities:
+        print(
+            f"FP32 vs INT8 pipeline embedding cosine over {len(similarities)} images: "
+            f"min={min(similarities):.4f} mean={np.mean(similarities):.4f}"
+        )
+
+if __name__ == "__main__":
+    main()
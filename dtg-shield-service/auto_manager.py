@@ -1,8 +1,12 @@
 import asyncio
 from config import config
-from risk_engine import RiskEngine
+from risk_engine import RiskEngine, BLOCK_KEY_PREFIX
 from datetime import datetime
-import json
+
+# Pubsub keyevents are fire-and-forget, so the Redis subnet index is also
+# rebuilt from the live block keys every N analysis cycles (5 min at 60s)
+RECONCILE_EVERY_CYCLES = 5
+LISTENER_RETRY_SEC = 5
 
 class AutoManager:
     """
@@ -12,13 +16,25 @@ class AutoManager:
     or prune stale risk scores dynamically.
     """
     def __init__(self):
-        self.risk_engine = RiskEngine()
+        self.risk_engine = RiskEngine(watch_settings=False)
         self.running = False
+        # True while expiry notifications keep the Redis subnet index current;
+        # otherwise subnets are aggregated from the live block keys each cycle
+        self.index_live = False
         
     async def start(self):
         await self.risk_engine.connect()
         self.running = True
+        try:
+            # E = keyevent channel, $ = SET (new block), x = expired, g = DEL (admin manual unblock)
+            self.index_live = await self.risk_engine.ensure_keyspace_events("E$xg")
+        except Exception as e:
+            print(f"[AutoManager] Could not read notify-keyspace-events: {e}")
+        if not self.index_live:
+            print("[AutoManager] Keyspace notifications unavailable, aggregating subnets from live block keys")
         print("[AutoManager] Autonomous AI Manager started. Running background heuristics...")
+        if self.index_live:
+            asyncio.create_task(self._block_release_listener())
         asyncio.create_task(self._pruning_loop())
 
     async def stop(self):
@@ -27,37 +43,74 @@ class AutoManager:
         print("[AutoManager] Shutting down.")
 
     async def _pruning_loop(self):
+        cycle = 0
         while self.running:
             try:
+                cycle += 1
+                if self.index_live and cycle % RECONCILE_EVERY_CYCLES == 0:
+                    # Catches dropped notifications and refreshes the index TTL
+                    await self.risk_engine.rebuild_block_index()
                 await self._analyze_and_prune()
             except Exception as e:
                 print(f"[AutoManager] Analysis error: {e}")
             await asyncio.sleep(60) # Run analysis every 60 seconds
             
+    async def _block_release_listener(self):
+        """Keeps the subnet index in sync as shield:block:* keys are set, expire or are deleted."""
+        redis_client = self.risk_engine.redis
+        db = redis_client.connection_pool.connection_kwargs.get("db", 0)
+        while self.running:
+            pubsub = redis_client.pubsub()
+            try:
+                set_channel = f"__keyevent@{db}__:set"
+                await pubsub.subscribe(set_channel, f"__keyevent@{db}__:expired", f"__keyevent@{db}__:del")
+                # Rebuild only after subscribing so no expiry can fall between the two
+                await self.risk_engine.rebuild_block_index()
+                async for message in pubsub.listen():
+                    if not self.running:
+                        break
+                    if message["type"] != "message":
+                        continue
+                    key = message["data"]
+                    if not key.startswith(BLOCK_KEY_PREFIX):
+                        continue
+                    ip = key[len(BLOCK_KEY_PREFIX):]
+                    if message["channel"] == set_channel:
+                        await self.risk_engine.index_block(ip)
+                    else:
+                        await self.risk_engine.release_block(ip)
+            except Exception as e:
+                print(f"[AutoManager] Block release listener error, resubscribing in {LISTENER_RETRY_SEC}s: {e}")
+            finally:
+                await pubsub.aclose()
+            if self.running:
+                await asyncio.sleep(LISTENER_RETRY_SEC)
+
     async def _analyze_and_prune(self):
         """
         AI-Inspired Logic:
-        1. Read all blocked IPs.
+        1. Read per-subnet blocked IP counts (maintained in Redis from block set / expiry events,
+           or aggregated from the live block keys when notifications are unavailable).
         2. Identify if >5 distinct IPs come from the same Class C subnet (/24).
         3. If so, proactively block the entire subnet logic (simulated for MVP).
         4. Lower universal block thresholds during high overall failure rates.
         """
-        blocked_ips = await self.risk_engine.get_all_blocked()
-        
-        subnet_counts = {}
-        for ip in blocked_ips.keys():
-            parts = ip.split(".")
-            if len(parts) == 4:
-                subnet = f"{parts[0]}.{parts[1]}.{parts[2]}.0/24"
-                subnet_counts[subnet] = subnet_counts.get(subnet, 0) + 1
+        if self.index_live:
+            subnet_counts = await self.risk_engine.get_subnet_counts()
+            active_blocks = await self.risk_engine.get_indexed_block_count()
+        else:
+            blocked_ips = await self.risk_engine.get_all_blocked()
+            subnet_counts = self.risk_engine.count_subnets(blocked_ips)
+            active_blocks = len(blocked_ips)
                 
         # Proactively identify malicious subnets
-        for subnet, count in subnet_counts.items():
+        for prefix, count in subnet_counts.items():
             if count >= 3: # Threshold
+                subnet = self.risk_engine.format_subnet(prefix)  # Format only the hotspots
                 print(f"[AutoManager] 🚨 HEURISTIC ALERT: High risk detected on subnet {subnet} ({count} blocked IPs). Consider CIDR blocking.")
                 
         # Simulate active pruning logging
-        print(f"[AutoManager] Heartbeat: Analyzed {len(blocked_ips)} active blocks.")
+        print(f"[AutoManager] Heartbeat: Analyzed {active_blocks} active blocks.")
         
 if __name__ == "__main__":
     manager = AutoManager()
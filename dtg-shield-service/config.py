@@ -11,6 +11,15 @@ class Settings(BaseSettings):
     
     # Redis Integration
     REDIS_URL: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    # Let the Shield add the notify-keyspace-events flags it needs (server-wide
+    # CONFIG SET). Off by default: configure Redis yourself, see README.
+    REDIS_MANAGE_KEYSPACE_EVENTS: bool = False
+    
+    # Local MaxMind databases for geo / VPN checks (mmap'd, no network I/O).
+    # Leave empty to fall back to ip-api.com lookups cached in Redis.
+    GEOIP_COUNTRY_DB: str = os.getenv("GEOIP_COUNTRY_DB", "")    # GeoLite2-Country.mmdb
+    GEOIP_ASN_DB: str = os.getenv("GEOIP_ASN_DB", "")            # GeoLite2-ASN.mmdb
+    DATACENTER_ASN_FILE: str = os.getenv("DATACENTER_ASN_FILE", "")  # One hosting/VPN ASN per line
     
     # AI/Heuristic Settings
     BASE_LATENCY_THRESHOLD_MS: int = 500
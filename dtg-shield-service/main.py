@@ -8,7 +8,7 @@ Heuristically analyzes and proxies traffic safely.
 """
 
 from fastapi import FastAPI, Request, HTTPException, status
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import httpx
 import uvicorn
 import time
@@ -17,12 +17,15 @@ import asyncio
 from config import config
 from risk_engine import RiskEngine
 
-app = FastAPI(title="DTG Shield Service", version="1.0.0")
+app = FastAPI(title="DTG Shield Service", version="1.0.0", default_response_class=ORJSONResponse)
 risk_engine = RiskEngine()
 
 # Initialize HTTP client for proxying
 client = httpx.AsyncClient(base_url=config.BACKEND_URL, timeout=30.0)
 
+# Path prefixes that bypass Shield checks (tuple so str.startswith matches them all in C)
+ADMIN_PATHS = ("/api/v1/admin/",)
+
 @app.on_event("startup")
 async def startup_event():
     print(f"Starting Shield Service on port {config.PORT}")
@@ -49,9 +52,8 @@ async def shield_middleware(request: Request, call_next):
     # Authenticated admin routes and the admin login endpoint bypass all
     # Shield risk/geo/VPN checks. The backend's requireAdmin middleware still
     # enforces valid JWT authentication, so there is no security gap.
-    ADMIN_PATHS = ["/api/v1/admin/"]
-    is_admin_path = any(request.url.path.startswith(p) for p in ADMIN_PATHS)
-    if is_admin_path:
+    path = request.url.path
+    if path.startswith(ADMIN_PATHS):
         response = await call_next(request)
         response.headers["X-Shield-Bypass"] = "admin"
         return response
@@ -63,7 +65,7 @@ async def shield_middleware(request: Request, call_next):
     is_blocked, reason = await risk_engine.is_ip_blocked(client_ip, request=request)
     
     if is_blocked:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_403_FORBIDDEN,
             content={"error": "Access Denied by DTG Shield", "reason": reason},
             headers={"X-Shield-Blocked": "true"}
@@ -78,7 +80,7 @@ async def shield_middleware(request: Request, call_next):
     # Analyze rate limit headers from backend to dynamically adjust risk
     if response.status_code == 429:
         await risk_engine.increment_risk(client_ip, config.AUTH_FAIL_WEIGHT, "Backend 429 Rate Limit")
-    elif request.url.path.startswith("/api/v1/auth") and response.status_code == 401:
+    elif path.startswith("/api/v1/auth") and response.status_code == 401:
         await risk_engine.increment_risk(client_ip, config.AUTH_FAIL_WEIGHT, "Auth Failure")
         
     response.headers["X-Shield-Latency"] = str(latency_ms)
@@ -127,16 +129,14 @@ async def proxy(request: Request, path: str):
         
         target_resp = await client.send(req, stream=True)
         
-        async def stream_response():
-            async for chunk in target_resp.aiter_bytes():
-                yield chunk
-                
         # Filter response headers — keep content-encoding so browser can decompress if needed
         # Only strip transfer-encoding and content-length (recomputed by StreamingResponse)
         resp_headers = {k: v for k, v in target_resp.headers.items() if k.lower() not in ["content-length", "transfer-encoding"]}
                 
+        # Pipe raw upstream bytes in 64KB chunks — no decoding and no per-chunk
+        # wrapper generator (content-encoding is passed through unchanged)
         return StreamingResponse(
-            stream_response(),
+            target_resp.aiter_raw(64 * 1024),
             status_code=target_resp.status_code,
             headers=resp_headers,
             background=target_resp.aclose
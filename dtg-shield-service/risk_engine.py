@@ -1,18 +1,98 @@
 import redis.asyncio as redis
 from datetime import datetime
 from config import config
-import json
+from collections import Counter
+import asyncio
+import ipaddress
+import maxminddb
+import orjson
+import time
+
+BLOCK_KEY_PREFIX = "shield:block:"
+BLOCKED_IPS_KEY = "shield:blocked_ips"      # Set of currently blocked IPs
+SUBNET_COUNTS_KEY = "shield:subnet_counts"  # Hash: /24 prefix as int (a<<16|b<<8|c) -> blocked IPs
+# Refreshed by every rebuild, so a stopped AutoManager leaves no stale index behind
+BLOCK_INDEX_TTL_SEC = 900
+
+# Admin-managed policy keys: cached in-process, invalidated via keyspace events
+SETTINGS_KEYS = ("geo:settings", "geo:blocked_countries", "security:settings")
+SETTINGS_CACHE_TTL_SEC = 5
+SETTINGS_LISTENER_RETRY_SEC = 5
+
+# Reads the per-IP keys is_ip_blocked needs in one round-trip.
+# KEYS: block, biometric / login / enrollment rate-limit zsets.
+# A missing block comes back as nil (Lua false), zsets as ZCARD counts.
+_IP_SNAPSHOT_LUA = """
+return {
+    redis.call('GET', KEYS[1]),
+    redis.call('ZCARD', KEYS[2]),
+    redis.call('ZCARD', KEYS[3]),
+    redis.call('ZCARD', KEYS[4])
+}
+"""
+
+# Adds to an IP's risk score and records the event for the admin dashboard.
+# KEYS: risk score, event log.  ARGV: amount, ISO timestamp, reason.
+# Returns the new score. Log entries stay JSON: the backend's
+# /admin/shield/logs endpoint JSON.parse's them.
+_INCREMENT_RISK_LUA = """
+local current = redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], 3600)
+redis.call('LPUSH', KEYS[2], cjson.encode({
+    timestamp = ARGV[2],
+    amount = tonumber(ARGV[1]),
+    reason = ARGV[3],
+    total_score = current
+}))
+redis.call('LTRIM', KEYS[2], 0, 49)
+return current
+"""
 
 
 class RiskEngine:
-    def __init__(self):
+    def __init__(self, watch_settings: bool = True):
         self.redis = None
+        # AutoManager never reads admin settings, so it skips the invalidation listener
+        self.watch_settings = watch_settings
+        self._ip_snapshot_script = None
+        self._increment_risk_script = None
+        # key -> (parsed value, monotonic expiry)
+        self._settings_cache = {}
+        # key -> invalidation count; a reload started before an invalidation is not cached
+        self._settings_generation = {}
+        self._settings_listener = None
+        self._geo_reader = None
+        self._asn_reader = None
+        self._datacenter_asns = frozenset()
         self.block_threshold = config.BLOCK_THRESHOLD
 
     async def connect(self):
         self.redis = await redis.from_url(config.REDIS_URL, decode_responses=True)
+        # register_script caches the SHA and falls back to SCRIPT LOAD on NOSCRIPT
+        self._ip_snapshot_script = self.redis.register_script(_IP_SNAPSHOT_LUA)
+        self._increment_risk_script = self.redis.register_script(_INCREMENT_RISK_LUA)
+        if self.watch_settings:
+            try:
+                # K = keyspace channel, $ = SET family, g = DEL
+                settings_events = await self.ensure_keyspace_events("K$g")
+            except Exception as e:
+                print(f"[SHIELD] Could not read notify-keyspace-events: {e}")
+                settings_events = False
+            if settings_events:
+                self._settings_listener = asyncio.create_task(self._settings_invalidation_listener())
+            else:
+                print(f"[SHIELD] Settings keyspace events not enabled, settings refresh every {SETTINGS_CACHE_TTL_SEC}s")
+
+        self._geo_reader = self._open_mmdb(config.GEOIP_COUNTRY_DB)
+        self._asn_reader = self._open_mmdb(config.GEOIP_ASN_DB)
+        self._datacenter_asns = self._load_asn_list(config.DATACENTER_ASN_FILE)
 
     async def disconnect(self):
+        if self._settings_listener:
+            self._settings_listener.cancel()
+        for reader in (self._geo_reader, self._asn_reader):
+            if reader:
+                reader.close()
         if self.redis:
             await self.redis.close()
 
@@ -22,21 +102,11 @@ class RiskEngine:
 
     async def increment_risk(self, ip: str, amount: int, reason: str):
         """Increments risk score for an IP based on heuristic triggers."""
-        key = f"shield:risk:{ip}"
-
-        current = await self.redis.incrby(key, amount)
-        await self.redis.expire(key, 3600)  # Reset risk after 1 hour of inactivity
-
-        # Log reason for dashboard
-        log_key = f"shield:logs:{ip}"
-        log_entry = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "amount": amount,
-            "reason": reason,
-            "total_score": current
-        }
-        await self.redis.lpush(log_key, json.dumps(log_entry))
-        await self.redis.ltrim(log_key, 0, 49)  # Keep last 50 events
+        # Score bump, 1h inactivity expiry and dashboard log entry in one round-trip
+        current = await self._increment_risk_script(
+            keys=[f"shield:risk:{ip}", f"shield:logs:{ip}"],
+            args=[amount, datetime.utcnow().isoformat(), reason],
+        )
 
         # Auto-block if threshold reached
         if current >= self.block_threshold:
@@ -44,7 +114,7 @@ class RiskEngine:
 
     async def block_ip(self, ip: str, reason: str, duration_sec: int = 3600):
         """Applies a hard block to an IP and updates the O(1) block counter."""
-        block_key = f"shield:block:{ip}"
+        block_key = f"{BLOCK_KEY_PREFIX}{ip}"
         # Only increment counter if this IP isn't already blocked
         already_blocked = await self.redis.exists(block_key)
         await self.redis.setex(block_key, duration_sec, reason)
@@ -52,6 +122,45 @@ class RiskEngine:
             await self.redis.incr("shield:block_count")
         print(f"[SHIELD] BLOCKED IP {ip}: {reason}")
 
+    # =========================================================================
+    # SUBNET INDEX
+    # Written only by AutoManager (its keyevent listener and periodic rebuild),
+    # never on the request path, and expires if AutoManager stops.
+    # =========================================================================
+
+    async def index_block(self, ip: str):
+        """Adds a newly set block to the subnet index."""
+        # SADD guards against double-increment when an existing block is renewed
+        if not await self.redis.sadd(BLOCKED_IPS_KEY, ip):
+            return
+        prefix = self._subnet_prefix(ip)
+        if prefix is not None:
+            await self.redis.hincrby(SUBNET_COUNTS_KEY, prefix, 1)
+
+    async def release_block(self, ip: str):
+        """Removes an expired/deleted block from the subnet index."""
+        # SREM guards against double-decrement and blocks set before the last rebuild
+        if not await self.redis.srem(BLOCKED_IPS_KEY, ip):
+            return
+        prefix = self._subnet_prefix(ip)
+        if prefix is not None:
+            remaining = await self.redis.hincrby(SUBNET_COUNTS_KEY, prefix, -1)
+            if remaining <= 0:
+                await self.redis.hdel(SUBNET_COUNTS_KEY, prefix)
+
+    @staticmethod
+    def _subnet_prefix(ip: str) -> int | None:
+        """Returns the /24 prefix of an IPv4 address as an int, or None for anything else."""
+        try:
+            return int.from_bytes(ipaddress.IPv4Address(ip).packed[:3], "big")
+        except ValueError:
+            return None
+
+    @staticmethod
+    def format_subnet(prefix: int) -> str:
+        """Formats an int /24 prefix from _subnet_prefix as "a.b.c.0/24"."""
+        return f"{(prefix >> 16) & 255}.{(prefix >> 8) & 255}.{prefix & 255}.0/24"
+
     # =========================================================================
     # MASTER BLOCK CHECK
     # Layered in priority order:
@@ -64,33 +173,39 @@ class RiskEngine:
     async def is_ip_blocked(self, ip: str, request=None) -> tuple[bool, str]:
         """Checks if an IP is blocked using all synchronized policy layers."""
 
+        # Fetch all per-IP layer inputs in a single round-trip
+        reason, bio_count, login_count, enrollment_count = await self._ip_snapshot_script(keys=[
+            f"{BLOCK_KEY_PREFIX}{ip}",
+            f"rl:biometric:ip:{ip}",
+            f"rl:login:ip:{ip}",
+            f"rl:enrollment:ip:{ip}",
+        ])
+
         # --- LAYER 1: Shield Direct Block ---
-        reason = await self.redis.get(f"shield:block:{ip}")
         if reason:
             return True, f"Shield Risk Block: {reason}"
 
         # --- LAYER 2: Geo-Blocking (synced from Admin Geo-Blocking page) ---
         try:
-            geo_settings_raw = await self.redis.get("geo:settings")
-            if geo_settings_raw:
-                geo_settings = json.loads(geo_settings_raw)
+            geo_settings = await self._get_cached_settings("geo:settings")
+            if geo_settings:
                 if geo_settings.get("geo_blocking_enabled") == "true":
-                    blocked_countries_raw = await self.redis.get("geo:blocked_countries")
-                    if blocked_countries_raw:
-                        blocked_countries = json.loads(blocked_countries_raw)
-                        if blocked_countries:  # Only check if there are actual blocked countries
-                            country_code = await self._get_country_code(ip)
-                            if country_code and country_code.upper() in [c.upper() for c in blocked_countries]:
-                                print(f"[SHIELD] GEO-BLOCKED: {ip} from {country_code}")
-                                return True, f"Geo-Blocked: {country_code} is restricted"
+                    blocked_countries = await self._get_cached_settings(
+                        "geo:blocked_countries",
+                        transform=lambda codes: frozenset(c.upper() for c in codes),
+                    )
+                    if blocked_countries:  # Only check if there are actual blocked countries
+                        country_code = await self._get_country_code(ip)
+                        if country_code and country_code.upper() in blocked_countries:
+                            print(f"[SHIELD] GEO-BLOCKED: {ip} from {country_code}")
+                            return True, f"Geo-Blocked: {country_code} is restricted"
         except Exception as e:
             print(f"[SHIELD] Geo-sync error: {e}")
 
         # --- LAYER 3: Security Policies (synced from Admin Security Policies page) ---
         try:
-            sec_settings_raw = await self.redis.get("security:settings")
-            if sec_settings_raw:
-                sec_settings = json.loads(sec_settings_raw)
+            sec_settings = await self._get_cached_settings("security:settings")
+            if sec_settings:
 
                 # 3a. Device Attestation check (Root/Jailbreak)
                 if sec_settings.get("require_device_attestation") == "true":
@@ -101,7 +216,7 @@ class RiskEngine:
                                 ip, 20,
                                 "Missing device attestation token (Root/Jailbreak suspected)"
                             )
-                            reason = await self.redis.get(f"shield:block:{ip}")
+                            reason = await self.redis.get(f"{BLOCK_KEY_PREFIX}{ip}")
                             if reason:
                                 return True, f"Shield Risk Block: {reason}"
 
@@ -114,7 +229,6 @@ class RiskEngine:
 
                 # 3c. Biometric IP throttle synchronization
                 max_bio = int(sec_settings.get("max_biometric_attempts_per_ip", 10))
-                bio_count = await self.redis.zcard(f"rl:biometric:ip:{ip}")
                 if bio_count and bio_count >= max_bio:
                     await self.increment_risk(
                         ip,
@@ -127,12 +241,7 @@ class RiskEngine:
             print(f"[SHIELD] Security-policy-sync error: {e}")
 
         # --- LAYER 4: General Backend Rate Limit Heuristics ---
-        auth_keys = [
-            f"rl:login:ip:{ip}",
-            f"rl:enrollment:ip:{ip}",
-        ]
-        for key in auth_keys:
-            count = await self.redis.zcard(key)
+        for count in (login_count, enrollment_count):
             if count and count >= 50:
                 await self.increment_risk(
                     ip, int(count),
@@ -146,20 +255,102 @@ class RiskEngine:
     # PRIVATE HELPERS — cached external lookups
     # =========================================================================
 
+    async def _get_cached_settings(self, key: str, transform=None):
+        """
+        Returns the parsed JSON value of an admin settings key, served from an
+        in-process cache for up to SETTINGS_CACHE_TTL_SEC. Admin edits evict the
+        entry immediately through the keyspace listener.
+        transform, if given, is applied once on load and its result is cached.
+        """
+        now = time.monotonic()
+        cached = self._settings_cache.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        generation = self._settings_generation.get(key, 0)
+        raw = await self.redis.get(key)
+        value = orjson.loads(raw) if raw else None
+        if value is not None and transform is not None:
+            value = transform(value)
+        if self._settings_generation.get(key, 0) == generation:
+            self._settings_cache[key] = (value, now + SETTINGS_CACHE_TTL_SEC)
+        return value
+
+    async def _settings_invalidation_listener(self):
+        """Drops cached settings as soon as the backend rewrites or deletes them."""
+        db = self.redis.connection_pool.connection_kwargs.get("db", 0)
+        channels = {f"__keyspace@{db}__:{key}": key for key in SETTINGS_KEYS}
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(*channels)
+                # Edits made while unsubscribed were missed, so start from a cold cache
+                self._invalidate_settings(*SETTINGS_KEYS)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._invalidate_settings(channels[message["channel"]])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[SHIELD] Settings invalidation listener error, resubscribing in {SETTINGS_LISTENER_RETRY_SEC}s: {e}")
+            finally:
+                await pubsub.aclose()
+            await asyncio.sleep(SETTINGS_LISTENER_RETRY_SEC)
+
+    def _invalidate_settings(self, *keys: str):
+        for key in keys:
+            self._settings_generation[key] = self._settings_generation.get(key, 0) + 1
+            self._settings_cache.pop(key, None)
+
+    @staticmethod
+    def _open_mmdb(path: str):
+        """Opens a MaxMind database, or returns None if it is not configured/readable."""
+        if not path:
+            return None
+        try:
+            return maxminddb.open_database(path)
+        except (OSError, maxminddb.InvalidDatabaseError) as e:
+            print(f"[SHIELD] Could not open {path}, using ip-api.com fallback: {e}")
+            return None
+
+    @staticmethod
+    def _load_asn_list(path: str) -> frozenset:
+        """Reads one ASN per line ("AS" prefix and # comments allowed)."""
+        if not path:
+            return frozenset()
+        try:
+            with open(path) as f:
+                lines = (line.split("#", 1)[0].strip().upper().removeprefix("AS") for line in f)
+                return frozenset(int(line) for line in lines if line)
+        except (OSError, ValueError) as e:
+            print(f"[SHIELD] Could not load datacenter ASN list {path}: {e}")
+            return frozenset()
+
+    def _lookup_mmdb(self, reader, ip: str) -> dict:
+        try:
+            return reader.get(ip) or {}
+        except ValueError:  # Not a valid IP address
+            return {}
+
     async def _get_country_code(self, ip: str) -> str | None:
-        """Returns country code for an IP, using Redis cache (TTL 1h)."""
+        """
+        Returns country code for an IP from the local GeoLite2 database, or via
+        ip-api.com with a Redis cache (TTL 1h) when no database is configured.
+        """
+        if self._geo_reader is not None:
+            return (self._lookup_mmdb(self._geo_reader, ip).get("country") or {}).get("iso_code")
+
         cache_key = f"geo:ip:{ip}"
         cached_raw = await self.redis.get(cache_key)
         if cached_raw:
-            return json.loads(cached_raw).get("country_code")
+            return orjson.loads(cached_raw).get("country_code")
         try:
             import httpx as _httpx
             async with _httpx.AsyncClient(timeout=3.0) as _c:
                 r = await _c.get(f"http://ip-api.com/json/{ip}?fields=status,countryCode")
-                data = r.json()
+                data = orjson.loads(r.content)
                 if data.get("status") == "success":
                     country_code = data.get("countryCode")
-                    geo_payload = json.dumps({"country_code": country_code, "ip": ip})
+                    geo_payload = orjson.dumps({"country_code": country_code, "ip": ip})
                     await self.redis.setex(cache_key, 3600, geo_payload)
                     return country_code
         except Exception as lookup_err:
@@ -168,14 +359,23 @@ class RiskEngine:
 
     async def _check_vpn_cached(self, ip: str) -> tuple[bool, str]:
         """
-        Checks if IP is a VPN/proxy/datacenter. Result is cached in Redis
-        for 1 hour to avoid a live ip-api.com call on every request.
+        Checks if IP is a VPN/proxy/datacenter. With a local ASN database and
+        datacenter ASN list this is an in-memory lookup; otherwise the result
+        is cached in Redis for 1 hour to avoid a live ip-api.com call on every
+        request.
         Returns (is_vpn, reason_string).
         """
+        if self._asn_reader is not None and self._datacenter_asns:
+            record = self._lookup_mmdb(self._asn_reader, ip)
+            asn = record.get("autonomous_system_number")
+            if asn in self._datacenter_asns:
+                return True, f"asn=AS{asn} ({record.get('autonomous_system_organization')})"
+            return False, ""
+
         cache_key = f"shield:vpn:{ip}"
         cached_raw = await self.redis.get(cache_key)
         if cached_raw:
-            cached = json.loads(cached_raw)
+            cached = orjson.loads(cached_raw)
             return cached.get("is_vpn", False), cached.get("reason", "")
 
         try:
@@ -184,12 +384,12 @@ class RiskEngine:
                 r = await _c.get(
                     f"http://ip-api.com/json/{ip}?fields=status,proxy,hosting,query"
                 )
-                data = r.json()
+                data = orjson.loads(r.content)
                 if data.get("status") == "success":
                     is_vpn = bool(data.get("proxy") or data.get("hosting"))
                     reason = f"proxy={data.get('proxy')}, hosting={data.get('hosting')}"
                     # Cache result for 1 hour — VPN status rarely changes
-                    payload = json.dumps({"is_vpn": is_vpn, "reason": reason})
+                    payload = orjson.dumps({"is_vpn": is_vpn, "reason": reason})
                     await self.redis.setex(cache_key, 3600, payload)
                     return is_vpn, reason
         except Exception as vpn_err:
@@ -206,13 +406,71 @@ class RiskEngine:
         count = await self.redis.get("shield:block_count")
         return int(count) if count else 0
 
+    async def get_subnet_counts(self) -> dict:
+        """Returns {int /24 prefix: blocked_ip_count} from the Redis-side index."""
+        raw = await self.redis.hgetall(SUBNET_COUNTS_KEY)
+        return {int(prefix): int(count) for prefix, count in raw.items()}
+
+    async def get_indexed_block_count(self) -> int:
+        """Number of IPs currently tracked in the subnet index."""
+        return await self.redis.scard(BLOCKED_IPS_KEY)
+
+    def count_subnets(self, ips) -> Counter:
+        """Aggregates IPs into {int /24 prefix: count}, skipping non-IPv4 entries."""
+        return Counter(prefix for prefix in map(self._subnet_prefix, ips) if prefix is not None)
+
+    async def rebuild_block_index(self):
+        """
+        Rebuilds the blocked-IP set and subnet counters from the live block keys.
+        AutoManager runs this whenever its listener (re)subscribes and
+        periodically, covering dropped notifications.
+        """
+        blocked_ips = list((await self.get_all_blocked()).keys())
+        subnet_counts = self.count_subnets(blocked_ips)
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(BLOCKED_IPS_KEY, SUBNET_COUNTS_KEY)
+            if blocked_ips:
+                pipe.sadd(BLOCKED_IPS_KEY, *blocked_ips)
+            if subnet_counts:
+                pipe.hset(SUBNET_COUNTS_KEY, mapping=subnet_counts)
+            pipe.expire(BLOCKED_IPS_KEY, BLOCK_INDEX_TTL_SEC)
+            pipe.expire(SUBNET_COUNTS_KEY, BLOCK_INDEX_TTL_SEC)
+            await pipe.execute()
+
+    async def ensure_keyspace_events(self, flags: str) -> bool:
+        """
+        Returns True if notify-keyspace-events includes flags. Missing flags are
+        added (keeping the existing ones) only when REDIS_MANAGE_KEYSPACE_EVENTS
+        is set, since CONFIG SET changes publishing for every key on the server.
+        """
+        current = (await self.redis.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+        effective = current.replace("A", "g$lshzxetd")  # A is an alias for the event classes
+        missing = "".join(flag for flag in flags if flag not in effective)
+        if not missing:
+            return True
+        if not config.REDIS_MANAGE_KEYSPACE_EVENTS:
+            return False
+        await self.redis.config_set("notify-keyspace-events", current + missing)
+        return True
+
     async def get_all_blocked(self) -> dict:
         """Returns all blocked IPs with reasons and TTLs."""
-        keys = await self.redis.keys("shield:block:*")
+        # SCAN instead of KEYS so Redis is never stalled on a full keyspace walk
+        keys = [key async for key in self.redis.scan_iter(match=f"{BLOCK_KEY_PREFIX}*", count=500)]
         blocked = {}
-        for key in keys:
-            ip = key.split(":")[-1]
-            reason = await self.redis.get(key)
-            ttl = await self.redis.ttl(key)
-            blocked[ip] = {"reason": reason, "expires_in_sec": ttl}
+        # Pipeline GET + TTL in batches instead of two round-trips per key
+        for start in range(0, len(keys), 200):
+            batch = keys[start:start + 200]
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key in batch:
+                    pipe.get(key)
+                    pipe.ttl(key)
+                results = await pipe.execute()
+            for i, key in enumerate(batch):
+                reason, ttl = results[2 * i], results[2 * i + 1]
+                if reason is None:
+                    continue  # Expired between SCAN and GET
+                ip = key[len(BLOCK_KEY_PREFIX):]
+                blocked[ip] = {"reason": reason, "expires_in_sec": ttl}
         return blocked